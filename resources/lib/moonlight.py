@@ -5,12 +5,27 @@ Various functions to execute moonlight-embedded
 """
 import os
 import re
+import selectors
+import shlex
+import subprocess
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 import xbmc
 import xbmcgui
 from .avahi import host_check
-from .utils import stop_old_container, subprocess_runner, wait_or_cancel
+from .utils import (MOONLIGHT_CONTAINER, MOONLIGHT_IMAGE, ensure_moonlight_container,
+                    stop_moonlight_container, stop_old_container, stop_process,
+                    subprocess_runner, wait_or_cancel)
+
+_INSTALL_SCRIPT = os.path.join(os.path.dirname(__file__), "bin", "install_moonlight.sh")
+_GAME_RE = re.compile(r"(\d+)\.\s+(.*)")
+_PIN_RE = re.compile(rb"Please enter the following PIN on the target PC: (\d+)")
+_ALREADY_PAIRED_RE = re.compile(rb"Failed to pair to server: Already paired")
+
+# Seconds a successful host check is trusted for, so chained calls skip the mDNS scan
+_HOST_CHECK_TTL = 30
+_host_cache = {"time": None, "available": False}
 
 
 def install():
@@ -18,10 +33,7 @@ def install():
     Executes the installer script to configure/download the moonlight-embedded docker container
     :return: boolean for success of installation
     """
-    script = os.path.join(os.path.dirname(__file__), "bin",
-                          "install_moonlight.sh")
-    cmd = f"bash {script}"
-    proc = subprocess_runner(cmd.split(' '), 'install')
+    proc = subprocess_runner(["bash", _INSTALL_SCRIPT], 'install')
     (status,_) = wait_or_cancel(proc, 'Installation',
                          'Running installation...this may take a few minutes')
     if status == 0:
@@ -30,6 +42,27 @@ def install():
         return False
 
 
+def host_available():
+    """
+    Cached version of host_check, a failed check is never cached
+
+    :return: boolean for host availability
+    """
+    now = time.monotonic()
+    if _host_cache["time"] is None or now - _host_cache["time"] > _HOST_CHECK_TTL:
+        _host_cache.update(time=now, available=host_check())
+    if not _host_cache["available"]:
+        invalidate_host_cache()
+    return _host_cache["available"]
+
+
+def invalidate_host_cache():
+    """
+    Force the next host_available call to check the network again
+    """
+    _host_cache["time"] = None
+
+
 def launch(res, fps, bitrate, quitafter, hostip, usercustom):
     """
     Launches moonlight-embedded as an external process and kills Kodi so display is available
@@ -43,43 +76,59 @@ def launch(res, fps, bitrate, quitafter, hostip, usercustom):
     :param usercustom: any custom flags the user wants to pass to moonlight
     """
 
-    gameList = load_installed_games(hostip)
-    if not gameList:
+    games = load_installed_games(hostip)
+    if not games:
         xbmcgui.Dialog().ok("No games found.")
         return
     dialog = xbmcgui.Dialog()
-    gameIdx = dialog.select("Choose your Game:", gameList)
+    gameIdx = dialog.select("Choose your Game:", [name for _, name in games])
     if gameIdx == -1:
         xbmcgui.Dialog().ok("No valid game selected.")
         return
-    # We split at the first blank to get rid of the number in the beginning
-    # We also make sure to put the game name in quotation marks to ensure it to be treated as one arg
-    selectedGame = gameList[gameIdx].split(" ", 1)[1].replace("\n", "")
+    selectedGame = games[gameIdx][1]
+
+    # Launch docker, adjusted to just used input variables
+    # Arguments are passed as a list so no shell is involved and the game name stays one arg
+    args = ["docker", "run", "--rm", "--name", "moonlight", "-t",
+            "-v", "moonlight-home:/home/moonlight-user",
+            "-v", "/var/run/dbus:/var/run/dbus",
+            "--device", "/dev/vchiq", "--device", "/dev/input",
+            MOONLIGHT_IMAGE, "stream",
+            f"-{res}", "-fps", str(fps), "-bitrate", str(bitrate)]
+    # Send quit command from moonlight after existing (helpful for non-steam sessions):
+    if quitafter == "true":
+        args.append("-quitappafter")
+    # Custom flags are split like a shell would, so quoted values stay a single arg
+    try:
+        args += shlex.split(usercustom)
+    except ValueError as err:
+        # Checked before Kodi is stopped, so the user can still fix the setting
+        xbmcgui.Dialog().ok("Error", f"Invalid custom flags for moonlight: {err}")
+        return
+    args += ["-app", selectedGame]
+    if hostip:
+        args.append(hostip)
+
     xbmc.log(
         f"Streaming {selectedGame} with moonlight-embedded, Kodi will now exit.",
         xbmc.LOGINFO,
     )
-    # Send quit command from moonlight after existing (helpful for non-steam sessions):
-    quitflag = "-quitappafter" if quitafter == "true" else ""
-
-    os.system("systemctl stop kodi") # Must close kodi for proper video display
-
-    # Launch docker, adjusted to just used input variables
-    os.system('docker run --rm --name moonlight -t -v moonlight-home:/home/moonlight-user '
-        '-v /var/run/dbus:/var/run/dbus --device /dev/vchiq --device /dev/input '
-        f'clarkemw/moonlight-embedded-raspbian stream -{res} -fps {fps} -bitrate {bitrate} {quitflag} {usercustom} -app "{selectedGame}" {hostip}')
-
-    os.system("docker wait moonlight")
-
-    os.system("systemctl start kodi")
+    stop_moonlight_container() # Streaming runs in its own container with device access
+    subprocess.run(["systemctl", "stop", "kodi"], check=False) # Must close kodi for proper video display
 
+    try:
+        # docker run is attached, so it only returns once the stream has ended
+        subprocess.run(args, check=False)
+    finally:
+        # Always bring Kodi back, even if docker couldn't be executed
+        subprocess.run(["systemctl", "start", "kodi"], check=False)
 
 
 def load_installed_games(hostip):
     """
     request available games from the Gamestream host
 
-    :return: list of available games
+    :return: list of (index, name) tuples for the available games
     """
     proc = run_moonlight("list", hostip)
     if proc:
@@ -95,8 +144,13 @@ def load_installed_games(hostip):
             # 3. Steam
             # =========================================
             # A return code=0 signals that we were successful in obtaining the list.
-            gamelist = [game for game in result.splitlines() if re.search('^\d+\.',game)]
+            gamelist = [(int(m.group(1)), m.group(2).rstrip()) for line in result.splitlines()
+                        if (m := _GAME_RE.match(line))]
             return gamelist
+        invalidate_host_cache()
+        if result is None:
+            # Cancelled: stopping the docker exec client leaves moonlight running inside the container
+            stop_moonlight_container()
 
 
 def pair(hostip):
@@ -107,60 +161,80 @@ def pair(hostip):
         "Pairing", "Do you want to pair with a Gamestream host?")
     if opt:
         pDialog = xbmcgui.DialogProgress()
-        proc = run_moonlight("pair", hostip, blockio=False)
-        stdout = ""
+        proc = run_moonlight("pair", hostip)
+        stdout = bytearray()
         codeFlag = False
         pDialog.create("Pairing", "Launching pairing...")
-        while proc and proc.poll() is None and not pDialog.iscanceled():
-            try:
-                stdout += proc.stdout.read().decode()
-            except:
-                pass
+        sel = selectors.DefaultSelector()
+        if proc:
+            sel.register(proc.stdout, selectors.EVENT_READ)
+        while proc and not pDialog.iscanceled():
+            # Sleep until moonlight writes something, waking up periodically for the cancel check
+            if not sel.select(timeout=0.25):
+                continue
+            chunk = os.read(proc.stdout.fileno(), 4096)
+            if not chunk:
+                # EOF: moonlight has exited and all output has been read
+                proc.wait()
+                break
+            # Only rescan the tail a match could straddle plus the new chunk, not the whole output
+            window = stdout[-256:] + chunk
+            stdout += chunk
+            # Only the end of the output is inspected once moonlight exits
+            del stdout[:-8192]
             if not codeFlag:
-                code = re.search(r"Please enter the following PIN on the target PC: (\d+)", stdout)
+                code = _PIN_RE.search(window)
                 if code:
                     codeFlag = True
-                    code = code.groups()[0]
+                    code = code.group(1).decode()
                     pDialog.update(
                         50,
                         f"Please enter authentication code {code} on Gamestream host",
                     )
+        sel.close()
         if proc and not pDialog.iscanceled() and proc.returncode == 0:
             pDialog.update(100, "Complete!")
             time.sleep(3)
         else:
-            try:
-                proc.terminate()
-            except Exception:
-                pass
+            invalidate_host_cache()
+            if proc and proc.returncode is None:
+                stop_process(proc)
+                # Stopping the docker exec client leaves moonlight running inside the container
+                stop_moonlight_container()
         pDialog.close()
-        if re.search(r"Failed to pair to server: Already paired", stdout):
+        # Output is kept as raw bytes while pairing and only decoded here for the log
+        xbmc.log(f"moonlight pair output:\n{stdout.decode('utf-8', 'replace')}", xbmc.LOGDEBUG)
+        if _ALREADY_PAIRED_RE.search(stdout):
             opt = xbmcgui.Dialog().ok(
                 "Pairing",
                 "Gamestream credentials already exist for this host.")
 
 
-def run_moonlight(mode, hostip, blockio=True):
+def run_moonlight(mode, hostip):
     """
-    execute moonlight in a local subprocess (won't work for streaming)
+    execute moonlight in the long-lived moonlight container with docker exec (won't work for streaming)
 
     :param mode: moonlight execution mode (pair/unpair/list etc)
-    :param wait: wait for process to complete
-    :param block: allow reading of stdout to block
-    :return: subprocess object
+    :param hostip: gamestream host ip (blank if using autodetect)
+    :return: subprocess object or None
     """
-    stop_old_container(f"moonlight_{mode}")
-    if not hostip and not host_check():
+    # The mDNS browse is the slow part, the cleanup below runs on this thread while it is in flight
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        hostCheck = pool.submit(host_available) if not hostip else None
+        # Per-mode containers are no longer used, but may be left over from older versions
+        stop_old_container(f"moonlight_{mode}")
+    if hostCheck and not hostCheck.result():
         xbmcgui.Dialog().ok(
             "Error",
             "No Gamestream host auto-detected on local network. Check if the gamestream service is started and retry.",
         )
         return None
-    cmd = (
-        f"docker run --rm -t --name moonlight_{mode}"
-        f" -v moonlight-home:/home/moonlight-user -v /var/run/dbus:/var/run/dbus"
-        f" clarkemw/moonlight-embedded-raspbian {mode} {hostip}")
-    return subprocess_runner(cmd.rstrip().split(" "), "moonlight " + mode, blockio)
+    if not ensure_moonlight_container():
+        return None
+    cmd = ["docker", "exec", "-t", MOONLIGHT_CONTAINER, "moonlight", mode]
+    if hostip:
+        cmd.append(hostip)
+    return subprocess_runner(cmd, "moonlight " + mode)
 
 def update_moonlight():
     """
@@ -169,7 +243,9 @@ def update_moonlight():
     opt = xbmcgui.Dialog().yesno(
         "Update", "Do you want to update the moonlight-embedded docker container?")
     if opt:
-        cmd = "docker pull clarkemw/moonlight-embedded-raspbian"
-        proc = subprocess_runner(cmd.split(" "), "docker update")
+        cmd = ["docker", "pull", MOONLIGHT_IMAGE]
+        proc = subprocess_runner(cmd, "docker update")
         wait_or_cancel(proc, "Update",
                        "Running docker update...this may take a few minutes")
+        # Restarted from the updated image on the next moonlight command
+        stop_moonlight_container()
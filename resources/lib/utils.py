@@ -3,12 +3,60 @@
 """
 Utility functions for subprocesses and docker containers
 """
-import fcntl
+import atexit
+import http.client
+import json
 import os
+import selectors
+import socket
 import subprocess
 import time
+from collections import deque
+from urllib.parse import quote
 import xbmcgui
 
+MOONLIGHT_IMAGE = "clarkemw/moonlight-embedded-raspbian"
+MOONLIGHT_CONTAINER = "moonlight_svc"
+DOCKER_SOCKET = "/var/run/docker.sock"
+# Seconds to wait on the docker API, long enough for a container stop (10 s grace period)
+DOCKER_API_TIMEOUT = 30
+# Lines of command output kept for results and error messages
+OUTPUT_LINES = 500
+
+
+class _DockerConnection(http.client.HTTPConnection):
+    """
+    HTTP connection to the docker engine API over its UNIX socket
+    """
+
+    def __init__(self, path=DOCKER_SOCKET, timeout=DOCKER_API_TIMEOUT):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def _docker_api(method, path):
+    """
+    Send a request to the docker engine API, which is much cheaper than starting the docker CLI
+
+    :param method: HTTP method
+    :param path: API endpoint
+    :return: (HTTP status, response body)
+    :raises OSError: if the docker socket is missing, not accessible or times out
+    :raises http.client.HTTPException: if the response can't be parsed
+    """
+    conn = _DockerConnection()
+    try:
+        conn.request(method, path)
+        resp = conn.getresponse()
+        return (resp.status, resp.read())
+    finally:
+        conn.close()
+
 
 def subprocess_runner_blocking(cmd, desc):
     """
@@ -16,45 +64,115 @@ def subprocess_runner_blocking(cmd, desc):
 
     :param cmd: command to execute in list format
     :param desc: description of command being run (for error messages)
-    :return: subprocess object or None
+    :return: command output (last lines only) or None
     """
-    try:
-        proc = subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode()
-        return proc
-    except subprocess.CalledProcessError as procError:
-        msg = procError.output
-        xbmcgui.Dialog().ok(f"Error during {desc}", msg)
+    proc = subprocess.Popen(cmd,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    # Stream the output and only keep its end, so chatty commands don't pile up in memory
+    lines = deque(iter(proc.stdout.readline, b""), maxlen=OUTPUT_LINES)
+    proc.stdout.close()
+    proc.wait()
+    output = b"".join(lines).decode(errors="replace")
+    if proc.returncode != 0:
+        xbmcgui.Dialog().ok(f"Error during {desc}", output)
         return None
+    return output
 
-def subprocess_runner(cmd, desc, blockio=True):
+def subprocess_runner(cmd, desc):
     """
     execute command in a local subprocess
 
     :param cmd: command to execute in list format
     :param desc: description of command being run (for error messages)
-    :param block: allow reading of stdout to block
     :return: subprocess object or None
     """
+    # Own session so the docker client isn't tied to Kodi's process group
     proc = subprocess.Popen(cmd,
                             stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
-    if not blockio:
-        fd = proc.stdout.fileno()
-        fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-        fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+                            stderr=subprocess.STDOUT,
+                            close_fds=True,
+                            start_new_session=True)
     return proc
 
 
+def container_running(container):
+    """
+    Check if docker container is running
+
+    :param container: name of docker container to check
+    :return: boolean for container state
+    """
+    try:
+        (status, body) = _docker_api("GET", f"/containers/{quote(container)}/json")
+        return status == 200 and json.loads(body)["State"]["Running"]
+    except (OSError, http.client.HTTPException):
+        # Docker socket unusable, fall back to the CLI
+        check = subprocess.run(
+            ["docker", "inspect", "-f", "{{.State.Running}}", container],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=False)
+        return check.returncode == 0 and check.stdout.strip() == b"true"
+
+
+def ensure_moonlight_container():
+    """
+    Start the long-lived moonlight container if it is not running yet, so that
+    moonlight commands can be run with docker exec instead of a new docker run each time
+
+    :return: boolean for container availability
+    """
+    if not container_running(MOONLIGHT_CONTAINER):
+        cmd = ["docker", "run", "-d", "--rm", "--init", "--name", MOONLIGHT_CONTAINER,
+               "-v", "moonlight-home:/home/moonlight-user", "-v", "/var/run/dbus:/var/run/dbus",
+               "--entrypoint", "sleep", MOONLIGHT_IMAGE, "infinity"]
+        # Run under the progress dialog, docker may have to pull the image first
+        proc = subprocess_runner(cmd, "moonlight container start")
+        (status, _) = wait_or_cancel(proc, "Moonlight", "Starting moonlight...")
+        if status != 0:
+            return False
+    # unregister first so the hook is only registered once per session
+    atexit.unregister(stop_moonlight_container)
+    atexit.register(stop_moonlight_container)
+    return True
+
+
+def stop_moonlight_container():
+    """
+    Stop the long-lived moonlight container (it is removed automatically once stopped)
+    """
+    try:
+        _docker_api("POST", f"/containers/{MOONLIGHT_CONTAINER}/stop")
+    except (OSError, http.client.HTTPException):
+        subprocess.run(["docker", "stop", MOONLIGHT_CONTAINER],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+
 def stop_old_container(container):
     """
     Check if docker container is running and stop if necessary
 
     :param container: name of docker container to check
     """
-    check = subprocess_runner_blocking("docker ps".split(" "), "container check")
-    if check and container in check:
-        stop = f"docker container stop {container}"
-        subprocess_runner(stop.split(" "), "stop container")
+    if container_running(container):
+        try:
+            _docker_api("POST", f"/containers/{quote(container)}/stop")
+        except (OSError, http.client.HTTPException):
+            subprocess.run(["docker", "container", "stop", container],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+
+def stop_process(proc):
+    """
+    Terminate a subprocess and reap it so it doesn't linger as a zombie
+
+    :param proc: subprocess object
+    """
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
 
 
 def wait_or_cancel(proc, title, message):
@@ -68,11 +186,32 @@ def wait_or_cancel(proc, title, message):
     """
     pDialog = xbmcgui.DialogProgress()
     pDialog.create(title, "")
-    while proc and proc.poll() is None and not pDialog.iscanceled():
-        pDialog.update(50, message)
+    # The message never changes while waiting, so the dialog only needs setting once
+    pDialog.update(50, message)
+    # Drain the output while waiting so a chatty command never blocks on a full pipe,
+    # keeping only its last lines so long installs and pulls don't pile up in memory
+    lines = deque(maxlen=OUTPUT_LINES)
+    pending = b""
+    sel = selectors.DefaultSelector()
+    if proc:
+        sel.register(proc.stdout, selectors.EVENT_READ)
+    while proc and not pDialog.iscanceled():
+        # Sleep until there is output, waking up periodically for the cancel check
+        if not sel.select(timeout=0.25):
+            continue
+        chunk = os.read(proc.stdout.fileno(), 4096)
+        if not chunk:
+            # EOF: the command has exited and all output has been read
+            proc.wait()
+            break
+        *complete, pending = (pending + chunk).split(b"\n")
+        lines.extend(complete)
+        pending = pending[-4096:]
+    sel.close()
     try:
         if not pDialog.iscanceled():
-            msg = proc.communicate()[0].decode()
+            lines.append(pending)
+            msg = b"\n".join(lines).decode(errors="replace")
             exitcode = proc.returncode
             if exitcode == 0:
                 stdout = msg
@@ -81,7 +220,7 @@ def wait_or_cancel(proc, title, message):
                 xbmcgui.Dialog().ok(f"Error during {title.lower()}", msg)
                 stdout = msg
         else:
-            proc.terminate()
+            stop_process(proc)
             stdout = None
             exitcode = 1
     except Exception: